@@ -1,61 +1,218 @@
+import functools
+import math
+import numbers
+import operator
+import re
+import sys
+import zlib
+from enum import IntEnum
+import weakref
+from weakref import WeakValueDictionary
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional, lower() then returns plain Python
+    njit = None
+
+# Interning table shared by Var, Num and BinOp: structurally identical
+# nodes are built once and reused for as long as something refers to them.
+_cache = WeakValueDictionary()
+
+
+class Op(IntEnum):
+    """Tags for the binary operators, ordered by precedence"""
+
+    ADD = 0
+    SUB = 1
+    MUL = 2
+    DIV = 3
+
+
+# indexed by Op. On NumPy arrays these go straight to the matching
+# ufuncs (np.add, np.subtract, ...), so evaluating with arrays in the
+# mapping fills a whole array per node without importing numpy here.
+_OPS = (operator.add, operator.sub, operator.mul, operator.truediv)
+_OP_SYMS = ("+", "-", "*", "/")
+
 
 class Expr:
     """Most fundamental class that defines a symbolic
     expression"""
 
+    # no per-node __dict__; __weakref__ lets nodes live in the intern cache
+    __slots__ = ("__weakref__", "_built", "_hash", "_function")
+
     def precedence(self):
         return 10  # a high number
 
+    # nodes are immutable and interned, so a copy is the node itself
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
     def __add__(self, other):
-        return Add(self, other)
+        other = _coerce(other)
+        if other is NotImplemented:
+            return other
+        return Add._raw(self, other)
 
     def __radd__(self, other):
-        return Add(other, self)
+        other = _coerce(other)
+        if other is NotImplemented:
+            return other
+        return Add._raw(other, self)
 
     def __sub__(self, other):
-        return Sub(self, other)
+        other = _coerce(other)
+        if other is NotImplemented:
+            return other
+        return Sub._raw(self, other)
 
     def __rsub__(self, other):
-        return Sub(other, self)
+        other = _coerce(other)
+        if other is NotImplemented:
+            return other
+        return Sub._raw(other, self)
 
     def __mul__(self, other):
-        return Mul(self, other)
+        other = _coerce(other)
+        if other is NotImplemented:
+            return other
+        return Mul._raw(self, other)
 
     def __rmul__(self, other):
-        return Mul(other, self)
+        other = _coerce(other)
+        if other is NotImplemented:
+            return other
+        return Mul._raw(other, self)
 
     def __truediv__(self, other):
-        return Div(self, other)
+        other = _coerce(other)
+        if other is NotImplemented:
+            return other
+        return Div._raw(self, other)
 
     def __rtruediv__(self, other):
-        return Div(other, self)
+        other = _coerce(other)
+        if other is NotImplemented:
+            return other
+        return Div._raw(other, self)
+
+    def compile(self):
+        """Flattens the expression into a Program that evaluates
+        it with a single loop instead of a tree walk. Shared nodes
+        get one slot and are computed once"""
+        instructions = []
+        var_indices = {}
+        constants = {}
+        slots = {}
+        size = 0
+
+        def new_slot():
+            nonlocal size
+            size += 1
+            return size - 1
+
+        def visit(node):
+            if id(node) in slots:
+                return slots[id(node)]
+            if isinstance(node, BinOp):
+                # n-ary Add/Mul become a chain of binary instructions
+                srcs = [visit(term) for term in node.terms]
+                dst = srcs[0]
+                for src in srcs[1:]:
+                    dst, src1 = new_slot(), dst
+                    instructions.append((int(node.Op), dst, src1, src))
+            elif isinstance(node, Var):
+                dst = var_indices[node.name] = new_slot()
+            else:
+                dst = new_slot()
+                constants[dst] = node.n
+            slots[id(node)] = dst
+            return dst
+
+        visit(self)
+        return Program(instructions, var_indices, constants, size)
+
+    def free_vars(self):
+        """Returns the set of variable names in the expression"""
+        names = set()
+        seen = set()
+
+        def visit(node):
+            if id(node) in seen:
+                return
+            seen.add(id(node))
+            if isinstance(node, BinOp):
+                for term in node.terms:
+                    visit(term)
+            elif isinstance(node, Var):
+                names.add(node.name)
+
+        visit(self)
+        return names
+
+    def lower(self):
+        """Returns a function specialised to this expression, taking
+        the values of sorted(self.free_vars()) as positional arguments.
+        It is jitted with numba when numba is installed. The function is
+        kept on the node, so lowering the same expression again is free"""
+        function = getattr(self, "_function", None)
+        if function is None:
+            function = self._function = self.compile().lower()
+        return function
 
 
 class Var(Expr):
     """Class to define variables to be used in
     symbolic expression"""
 
+    __slots__ = ("name",)
+
+    def __new__(cls, name):
+        key = (cls, name)
+        self = _cache.get(key)
+        if self is None:
+            self = super().__new__(cls)
+            self._built = False
+            _cache[key] = self
+        return self
+
     def __init__(self, name):
         """
         Initializer.  Store an instance variable called `name`, containing the
         value passed in to the initializer.
         """
+        if self._built:
+            return
         self.name = name
+        # str hashes change between runs, a crc keeps the operand
+        # order of Add/Mul (and so printing) the same every run
+        self._hash = zlib.crc32(name.encode())
+        self._built = True
 
-    def evaluate(self, mapping):
+    def evaluate(self, mapping, memo=None):
         if self.name in mapping:
             return mapping[self.name]
         else:
             raise SymbolicEvaluationError("Value for one or more variables is missing")
 
+    def _key(self):
+        return (Var, self.name)
+
     def deriv(self, variable):
         if variable == self.name:
-            return Num(1)
+            return ONE
         else:
-            return Num(0)
+            return ZERO
 
     def __eq__(self, other):
-        return self.name == other.name
+        return self is other or (type(other) is Var and self.name == other.name)
+
+    def __hash__(self):
+        return self._hash
 
     def simplify(self):
         return self
@@ -66,28 +223,67 @@ class Var(Expr):
     def __repr__(self):
         return f"Var('{self.name}')"
 
+    def __reduce__(self):
+        # unpickle through the constructor so the node is interned
+        return (Var, (self.name,))
+
 
 class Num(Expr):
     """Class to define number object to be used in
     symbolic algebra"""
 
+    __slots__ = ("n",)
+
+    @staticmethod
+    def _value_key(n):
+        """Key telling apart numbers that compare equal but print or
+        behave differently: Num(2) and Num(2.0), Num(0.0) and Num(-0.0)"""
+        if isinstance(n, float):
+            return (type(n), n, math.copysign(1.0, n))
+        return (type(n), n)
+
+    def __new__(cls, n):
+        key = (cls,) + cls._value_key(n)
+        self = _cache.get(key)
+        if self is None:
+            self = super().__new__(cls)
+            self._built = False
+            _cache[key] = self
+        return self
+
     def __init__(self, n):
         """
         Initializer.  Store an instance variable called `n`, containing the
         value passed in to the initializer.
         """
+        if self._built:
+            return
         self.n = n
+        # as distinct as the intern key, so 2 and 2.0 hash apart; the
+        # type goes in by name, which hashes the same in every run
+        key = self._value_key(n)
+        self._hash = hash((zlib.crc32(key[0].__name__.encode()),) + key[1:])
+        self._built = True
 
     def deriv(self, variable):
         # constant differentiation
-        return Num(0)
+        return ZERO
 
     def __eq__(self, other):
-        return self.n == other.n
+        # Num(2) and Num(2.0) are different nodes, so they are unequal
+        return self is other or (
+            type(other) is Num and self._value_key(self.n) == self._value_key(other.n)
+        )
 
-    def evaluate(self, mapping):
+    def __hash__(self):
+        return self._hash
+
+    def evaluate(self, mapping, memo=None):
         return self.n
 
+    def _key(self):
+        return (Num,) + self._value_key(self.n)
+
     def simplify(self):
         return self
 
@@ -97,214 +293,556 @@ class Num(Expr):
     def __repr__(self):
         return f"Num({self.n})"
 
+    def __reduce__(self):
+        return (Num, (self.n,))
+
+
+# canonical constants, Num(0) and Num(1) intern to these
+ZERO = Num(0)
+ONE = Num(1)
+
+
+def _coerce(x):
+    """Turns a user supplied operand into an Expr: numbers
+    become Num and names become Var. Anything else gives
+    NotImplemented, so that the other operand may handle it"""
+    if isinstance(x, Expr):
+        return x
+    if isinstance(x, numbers.Number):
+        return Num(x)
+    if isinstance(x, str):
+        return Var(x)
+    return NotImplemented
+
+
+# structural hash of a node, also the order of the terms of Add/Mul
+_term_order = operator.attrgetter("_hash")
+
+
+def _tie_order(term):
+    """Full order of the terms of Add/Mul. Hashes can be equal for
+    different terms (the crc32 of two Var names may collide), and the
+    order of those must not depend on which one was built first"""
+    return (term._hash, type(term).__name__, str(term))
+
+
+def _sort_terms(terms):
+    """Sorts terms in place by _tie_order, without building the
+    strings of the terms unless two of them have the same hash"""
+    terms.sort(key=_term_order)
+    if len(set(map(_term_order, terms))) < len(terms):
+        terms.sort(key=_tie_order)
+
+# Add/Mul hash as the sum of their spread term hashes, so merging one
+# more term into a node updates its hash without visiting the others
+_HASH_MODULUS = sys.hash_info.modulus
+
+
+def _spread(h):
+    return hash((h,))
+
+
+# (cls, hash) pairs shared by live Add/Mul nodes over different terms,
+# with the number of those nodes, which are keyed on their terms too
+_collided = {}
+
+
+def _hold_collided(key, node):
+    _collided[key] = _collided.get(key, 0) + 1
+    weakref.finalize(node, _release_collided, key).atexit = False
+
+
+def _release_collided(key):
+    _collided[key] -= 1
+    if not _collided[key]:
+        del _collided[key]
+
+
+def _same_terms(a, b):
+    # terms are interned, so identity is enough and skips the
+    # structural comparison of ==
+    return len(a) == len(b) and all(map(operator.is_, a, b))
+
+
+def _insort(terms, term):
+    """Inserts term into terms, a list sorted by _tie_order"""
+    # bisect.insort only takes key= from Python 3.10
+    h = term._hash
+    lo, hi = 0, len(terms)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if h < terms[mid]._hash:
+            hi = mid
+        else:
+            lo = mid + 1
+    # step back over the terms with the same hash that order after it
+    if lo and terms[lo - 1]._hash == h:
+        key = _tie_order(term)
+        while lo and terms[lo - 1]._hash == h and _tie_order(terms[lo - 1]) > key:
+            lo -= 1
+    terms.insert(lo, term)
+
 
 ## Classes of Binary Operators
 class BinOp(Expr):
     """Class that represents a Binary Operator of
-    some operation between a left symbolic expression and
-    a right symbolic expression."""
-
-    def __init__(self, left, right, Op):
-        # check and change
-        if isinstance(left, str):
-            left = Var(left)
-        if isinstance(left, (float, int)):
-            left = Num(left)
-        if isinstance(right, str):
-            right = Var(right)
-        if isinstance(right, (float, int)):
-            right = Num(right)
-
-        self.left = left
-        self.right = right
-        self.Op = Op
+    some operation between symbolic expressions. Its
+    subclasses hold the operands as terms: NonAssocOp
+    a left and a right one, AssocOp any number of them."""
+
+    __slots__ = ("Op", "_prec", "_str", "_deriv_cache")
+
+    def __new__(cls, left, right, *args):
+        operands = _coerce(left), _coerce(right)
+        if NotImplemented in operands:
+            raise TypeError(
+                f"unsupported operand types for {cls.__name__}: "
+                f"{type(left).__name__!r} and {type(right).__name__!r}"
+            )
+        return cls._raw(*operands, *args)
+
+    def __init__(self, left, right, op):
+        if self._built:
+            return
+        self.Op = op
+        # P-E-MD-AS, fixed for the lifetime of the node
+        self._prec = 1 if op <= Op.SUB else 2
+        self._str = None
+        self._deriv_cache = None
+        # _hash is set by the subclass that builds the node
+        self._built = True
 
     def eval_Op(self, left, right):
-        if self.Op == "Add":
-            return left + right
-        elif self.Op == "Sub":
-            return left - right
-        elif self.Op == "Mul":
-            return left * right
-        else:
-            return left / right
+        return _OPS[self.Op](left, right)
 
     def precedence(self):
-        # P-E-MD-AS
-        if self.Op in {"Sub", "Add"}:
-            return 1
-        if self.Op in {"Mul", "Div"}:
-            return 2
-        return 0
+        return self._prec
+
+    def evaluate(self, mapping, memo=None):
+        """mapping is the dictionary of variables to values, which
+        may be NumPy arrays to evaluate many points at once. The
+        result has the shape of the arrays only when it depends on
+        them: an expression folded to a constant, like x * 0, is a
+        Num and evaluates to that number. memo is an optional
+        dictionary from node id to value, so that shared nodes
+        evaluate once"""
+        if memo is not None and id(self) in memo:
+            return memo[id(self)]
+        out = self._evaluate(mapping, memo)
+        if memo is not None:
+            memo[id(self)] = out
+        return out
+
+    @staticmethod
+    def _fold(left, right):
+        """Returns a simpler expression equal to the operation on
+        left and right, or None when there is none"""
+        return None
 
-    def evaluate(self, mapping):
-        """mapping is the dictionary
-        of variables to values"""
-        # the mapping will only contain the values of the variables
-        left, right = self.left, self.right
-        left_eval = left.evaluate(mapping)
-        right_eval = right.evaluate(mapping)
-        return self.eval_Op(left_eval, right_eval)
+    def deriv(self, variable):
+        # a node shared across the tree is differentiated once per variable
+        cache = self._deriv_cache
+        if cache is None:
+            cache = self._deriv_cache = {}
+        if variable not in cache:
+            cache[variable] = self._deriv(variable)
+        return cache[variable]
+
+    def simplify(self):
+        # _raw folds every node it builds and its children were built
+        # the same way, so the node is already in simplified form
+        return self
+
+    def _key(self):
+        """Hashable key of this node. Children are expected to be
+        shared already (see cse), so their ids stand in for them"""
+        return (type(self),) + tuple(map(id, self.terms))
 
     def __eq__(self, other):
-        if self.Op != other.Op:
+        # interned nodes are almost always caught by the identity check
+        if self is other:
+            return True
+        if type(self) is not type(other) or self._hash != other._hash:
             return False
+        # operands of Add/Mul are in canonical order, so no swapped check
+        return self.terms == other.terms
+
+    def __hash__(self):
+        return self._hash
+
+
+class NonAssocOp(BinOp):
+    """Class that represents an operation that is neither
+    associative nor commutative, between a left symbolic
+    expression and a right symbolic expression."""
+
+    __slots__ = ("left", "right")
+
+    @classmethod
+    def _raw(cls, left, right, *args):
+        """Builds the node for operands that are already Expr,
+        skipping the type checks of the constructor. Constant
+        operands and identities such as x / 1 are folded here, so
+        the result may be a simpler expression than cls"""
+        folded = cls._fold(left, right)
+        if folded is not None:
+            return folded
+
+        # children are interned already, so their ids identify them
+        key = (cls, id(left), id(right)) + args
+        self = _cache.get(key)
+        if self is None:
+            self = Expr.__new__(cls)
+            # the node holds its children, which keeps the ids in key valid
+            self.left = left
+            self.right = right
+            # structural hash from the children's
+            self._hash = hash((cls._op, left._hash, right._hash))
+            self._built = False
+            self.__init__(left, right, *args)
+            _cache[key] = self
+        return self
 
-        # For commutative operations, allow swapped operands
-        if self.Op in {"Add", "Mul"}:
-            return (self.left == other.left and self.right == other.right) or (
-                self.left == other.right and self.right == other.left
-            )
+    @classmethod
+    def _from_terms(cls, terms):
+        """Builds the node over a sequence of operands"""
+        return cls._raw(*terms)
+
+    @property
+    def terms(self):
+        """The operands of the operation"""
+        return (self.left, self.right)
 
-        # For non-commutative operations (Sub, Div), require exact match
-        return self.left == other.left and self.right == other.right
+    def _evaluate(self, mapping, memo):
+        # the mapping will only contain the values of the variables
+        left_eval = self.left.evaluate(mapping, memo)
+        right_eval = self.right.evaluate(mapping, memo)
+        return self.eval_Op(left_eval, right_eval)
 
     def __repr__(self):
-        return f"{self.Op}({self.left.__repr__()}, {self.right.__repr__()})"
+        return f"{type(self).__name__}({self.left.__repr__()}, {self.right.__repr__()})"
+
+    def __reduce__(self):
+        return (type(self), (self.left, self.right))
 
     def __str__(self):
-        op_syms = {"Add": "+", "Sub": "-", "Mul": "*", "Div": "/"}
-        sym = f" {op_syms[self.Op]} "
+        # nodes are immutable, so the string is built once
+        if self._str is not None:
+            return self._str
+        sym = f" {_OP_SYMS[self.Op]} "
 
         left, right = self.left, self.right
-        self_p = self.precedence()
+        self_p = self._prec
         left_p, right_p = left.precedence(), right.precedence()
 
         # Change Left String
         left_str = f"({left})" if left_p < self_p else str(left)
 
-        # Change Right String
-        if right_p < self_p or (self.Op in {"Sub", "Div"} and right_p == self_p):
+        # Change Right String, x - (y - z) and x / (y * z) need brackets
+        if right_p <= self_p:
             right_str = f"({right})"
         else:
             right_str = str(right)
 
-        return f"{left_str}{sym}{right_str}"
+        self._str = f"{left_str}{sym}{right_str}"
+        return self._str
+
+
+class AssocOp(BinOp):
+    """Class that represents an associative and commutative
+    operation as one node over a flat tuple of terms, so that
+    x + y + z is a single Add rather than Add(Add(x, y), z)"""
+
+    __slots__ = ("terms",)
+
+    @classmethod
+    def _raw(cls, left, right):
+        # e + term: merge the one new term into the already sorted
+        # terms of e, instead of flattening and sorting all of them
+        if type(left) is cls and type(right) is not cls and type(right) is not Num:
+            terms = list(left.terms)
+            _insort(terms, right)
+            return cls._intern(terms, left._hash + _spread(right._hash))
+        if type(right) is cls and type(left) is not cls and type(left) is not Num:
+            terms = list(right.terms)
+            _insort(terms, left)
+            return cls._intern(terms, right._hash + _spread(left._hash))
+        return cls._from_terms((left, right))
+
+    @classmethod
+    def _from_terms(cls, terms):
+        """Builds the node over terms. Nested nodes of the same class
+        are absorbed, numbers are folded into one constant and the rest
+        is sorted by _tie_order, so equal sums/products are the same node"""
+        flat = []
+        numbers = []
+        for term in terms:
+            for t in term.terms if type(term) is cls else (term,):
+                if isinstance(t, Num):
+                    numbers.append(t.n)
+                else:
+                    flat.append(t)
+
+        #Simplification_cases
+        if numbers:
+            n = functools.reduce(_OPS[cls._op], numbers)
+            if n == cls._absorbing:
+                return ZERO
+            if n != cls._identity or not flat:
+                flat.append(Num(n))
+        if len(flat) == 1:
+            return flat[0]
+
+        _sort_terms(flat)
+        return cls._intern(flat, cls._op + sum(map(_spread, map(_term_order, flat))))
+
+    @classmethod
+    def _intern(cls, terms, h):
+        """Returns the node over terms, which must already be in
+        canonical form: flat, sorted, at most one number. h is
+        their hash, as computed by _from_terms, before the modulus"""
+        terms = tuple(terms)
+        h %= _HASH_MODULUS
+        # keyed on the hash rather than on every term, so building
+        # stays O(len(terms)); a hit still has to match the terms
+        key = (cls, h)
+        collided = key in _collided
+        if collided:
+            key += tuple(map(id, terms))
+        self = _cache.get(key)
+        if self is not None:
+            if collided or _same_terms(self.terms, terms):
+                return self
+            # another node holds the hash: for as long as one of them
+            # lives, every node with it is keyed on its terms as well
+            del _cache[key]
+            _cache[key + tuple(map(id, self.terms))] = self
+            _hold_collided(key, self)
+            collided = True
+            key += tuple(map(id, terms))
+        self = Expr.__new__(cls)
+        self.terms = terms
+        self._hash = h
+        self._built = False
+        self.__init__(terms[0], terms[1])
+        _cache[key] = self
+        if collided:
+            _hold_collided(key[:2], self)
+        return self
+
+    def __reduce__(self):
+        return (type(self)._from_terms, (self.terms,))
+
+    @property
+    def left(self):
+        return self.terms[0]
+
+    @property
+    def right(self):
+        # any tail of canonical terms is canonical too
+        terms = self.terms
+        if len(terms) == 2:
+            return terms[1]
+        return self._intern(terms[1:], self._hash - _spread(terms[0]._hash))
+
+    def _evaluate(self, mapping, memo):
+        values = [term.evaluate(mapping, memo) for term in self.terms]
+        return functools.reduce(_OPS[self.Op], values)
+
+    def __repr__(self):
+        # same nesting as building the terms pairwise, in one pass
+        name = type(self).__name__
+        *init, last = self.terms
+        head = "".join(f"{name}({term!r}, " for term in init)
+        return f"{head}{last!r}{')' * len(init)}"
 
+    def __str__(self):
+        # nodes are immutable, so the string is built once
+        if self._str is not None:
+            return self._str
+        parts = (
+            f"({term})" if term.precedence() < self._prec else str(term)
+            for term in self.terms
+        )
+        self._str = f" {_OP_SYMS[self.Op]} ".join(parts)
+        return self._str
 
-class Add(BinOp):
+
+class Add(AssocOp):
     """Class to represent Addition
-    Binary operation"""
+    operation over any number of terms"""
+
+    __slots__ = ()
+    _op = Op.ADD
+    _identity = 0
+    _absorbing = None
 
     def __init__(self, left, right):
-        BinOp.__init__(self, left, right, "Add")
+        BinOp.__init__(self, left, right, Op.ADD)
 
-    def deriv(self, variable):
-        return self.left.deriv(variable) + self.right.deriv(variable)
+    def _deriv(self, variable):
+        return Add._from_terms([term.deriv(variable) for term in self.terms])
 
-    def simplify(self):
-        l, r = self.left, self.right
-        ls = l.simplify()
-        rs = r.simplify()
-        #Simplification_cases
-        if isinstance(ls, Num):
-            if isinstance(rs, Num):
-                return Num(self.eval_Op(ls.n, rs.n))
-            
-            if ls == Num(0):
-                return rs
-            
-        if isinstance(rs, Num):
-            if rs == Num(0):
-                return ls    
-        
-        #Recursive
-        return self.eval_Op(ls, rs)
 
-class Sub(BinOp):
+class Sub(NonAssocOp):
     """Class to represent Subtraction
     Binary operation"""
 
+    __slots__ = ()
+    _op = Op.SUB
+
     def __init__(self, left, right):
-        BinOp.__init__(self, left, right, "Sub")
+        BinOp.__init__(self, left, right, Op.SUB)
 
-    def deriv(self, variable):
-        return self.left.deriv(variable) - self.right.deriv(variable)
-    
-    def simplify(self):
-        l, r = self.left, self.right
-        ls = l.simplify()
-        rs = r.simplify()
+    def _deriv(self, variable):
+        return Sub._raw(self.left.deriv(variable), self.right.deriv(variable))
+
+    @staticmethod
+    def _fold(ls, rs):
         #Simplification_cases
         if isinstance(ls, Num):
             if isinstance(rs, Num):
-                return Num(self.eval_Op(ls.n, rs.n))
-                        
+                return Num(ls.n - rs.n)
+
         if isinstance(rs, Num):
-            if rs == Num(0):
-                return ls    
-        
-        #Recursive
-        return self.eval_Op(ls, rs)
+            if rs.n == 0:
+                return ls
 
-class Mul(BinOp):
+        return None
+
+class Mul(AssocOp):
     """Class to represent Multiplication
-    binary operation"""
+    operation over any number of factors"""
 
-    def __init__(self, left, right):
-        BinOp.__init__(self, left, right, "Mul")
+    __slots__ = ()
+    _op = Op.MUL
+    _identity = 1
+    _absorbing = 0
 
-    def deriv(self, variable):
-        return ((self.left) * self.right.deriv(variable)) + (
-            self.right * self.left.deriv(variable)
+    def __init__(self, left, right):
+        BinOp.__init__(self, left, right, Op.MUL)
+
+    def _deriv(self, variable):
+        # product rule, one term per factor
+        terms = self.terms
+        return Add._from_terms(
+            [
+                Mul._from_terms(terms[:i] + (term.deriv(variable),) + terms[i + 1 :])
+                for i, term in enumerate(terms)
+            ]
         )
 
-    def simplify(self):
-        l, r = self.left, self.right
-        ls = l.simplify()
-        rs = r.simplify()
-        #Simplification_cases
-        if isinstance(ls, Num):
-            if isinstance(rs, Num):
-                return Num(self.eval_Op(ls.n, rs.n))
-            
-            if ls == Num(0):
-                return Num(0)
-            if ls == Num(1):
-                return rs
-            
-        if isinstance(rs, Num):
-            if rs == Num(0):
-                return Num(0)  
-            if rs == Num(1):
-                return ls
-        
-        #Recursive
-        return self.eval_Op(ls, rs)
-
-
 
-class Div(BinOp):
+class Div(NonAssocOp):
     """Class to represent Division Binary Operation"""
 
+    __slots__ = ()
+    _op = Op.DIV
+
     def __init__(self, left, right):
-        BinOp.__init__(self, left, right, "Div")
+        BinOp.__init__(self, left, right, Op.DIV)
 
-    def deriv(self, variable):
-        numerator = (self.right * self.left.deriv(variable)) - (
-            self.left * self.right.deriv(variable)
+    def _deriv(self, variable):
+        numerator = Sub._raw(
+            Mul._raw(self.right, self.left.deriv(variable)),
+            Mul._raw(self.left, self.right.deriv(variable)),
         )
-        denominator = self.right * self.right
-        return numerator / denominator
-    
-    def simplify(self):
-        l, r = self.left, self.right
-        ls = l.simplify()
-        rs = r.simplify()
+        denominator = Mul._raw(self.right, self.right)
+        return Div._raw(numerator, denominator)
+
+    @staticmethod
+    def _fold(ls, rs):
         #Simplification_cases
         if isinstance(ls, Num):
             if isinstance(rs, Num):
-                return Num(self.eval_Op(ls.n, rs.n))
-            
-            if ls == Num(0):
-                return Num(0)
-            
+                # leave division by zero for evaluate to report
+                return Num(ls.n / rs.n) if rs.n != 0 else None
+
+            if ls.n == 0:
+                return ZERO
+
         if isinstance(rs, Num):
-            if rs == Num(1):
+            if rs.n == 1:
                 return ls
-        
-        #Recursive
-        return self.eval_Op(ls, rs)
+
+        return None
+
+
+def cse(expr):
+    """Common subexpression elimination. Returns an expression equal
+    to expr in which equal subexpressions are one shared node, so
+    expr.evaluate(mapping, memo={}) computes each of them once"""
+    table = {}
+    done = {}
+
+    def visit(node):
+        if id(node) in done:
+            return done[id(node)]
+        out = node
+        if isinstance(node, BinOp):
+            terms = tuple(visit(term) for term in node.terms)
+            if any(new is not old for new, old in zip(terms, node.terms)):
+                out = type(node)._from_terms(terms)
+        out = table.setdefault(out._key(), out)
+        done[id(node)] = out
+        return out
+
+    return visit(expr)
+
+
+class Program:
+    """Flat form of an expression returned by Expr.compile.
+    Every subexpression owns a slot in a list of values, each
+    instruction (op, dst, src1, src2) stores
+    values[src1] <op> values[src2] into values[dst], and the
+    last slot holds the value of the whole expression"""
+
+    def __init__(self, instructions, var_indices, constants, size):
+        self.instructions = instructions
+        self.var_indices = var_indices
+        self.constants = constants
+        self.size = size
+
+    def evaluate(self, mapping):
+        values = [None] * self.size
+        for dst, n in self.constants.items():
+            values[dst] = n
+        for name, dst in self.var_indices.items():
+            if name not in mapping:
+                raise SymbolicEvaluationError(
+                    "Value for one or more variables is missing"
+                )
+            values[dst] = mapping[name]
+        for op, dst, src1, src2 in self.instructions:
+            values[dst] = _OPS[op](values[src1], values[src2])
+        return values[-1]
+
+    def source(self):
+        """Python source of a function computing the program with one
+        statement per instruction, so no opcode dispatch is left.
+        Arguments are the variables in sorted order, and constant cN
+        is looked up in the function's globals"""
+        names = sorted(self.var_indices)
+        refs = {self.var_indices[name]: f"v{i}" for i, name in enumerate(names)}
+        for dst in self.constants:
+            refs[dst] = f"c{dst}"
+        params = ", ".join(refs[self.var_indices[name]] for name in names)
+        lines = [f"def kernel({params}):"]
+        for op, dst, src1, src2 in self.instructions:
+            refs[dst] = f"t{dst}"
+            lines.append(f"    t{dst} = {refs[src1]} {_OP_SYMS[op]} {refs[src2]}")
+        lines.append(f"    return {refs[self.size - 1]}")
+        return "\n".join(lines) + "\n"
+
+    def lower(self):
+        """Executes source() and returns the resulting function,
+        wrapped with numba.njit when numba is available"""
+        namespace = {f"c{dst}": n for dst, n in self.constants.items()}
+        exec(self.source(), namespace)
+        kernel = namespace["kernel"]
+        # exec'd code has no file, so numba's on-disk cache does not apply
+        return kernel if njit is None else njit(kernel)
+
 
 class SymbolicEvaluationError(Exception):
     """
@@ -320,98 +858,134 @@ def make_expression(expression, flush=False):
     the expression interms of the expression class"""
     tokens = tokenize(expression)
     if flush:
+        tokens = list(tokens)
         print(f"Tokens: {tokens}", flush=True)
     expression = parse(tokens, flush)
     return expression
 
 
+class _Run:
+    """Operands of a chain of one associative operator met while
+    parsing, e.g. ((a + b) + c), built as one node once it ends"""
+
+    __slots__ = ("cls", "terms")
+
+    def __init__(self, cls, terms):
+        self.cls = cls
+        self.terms = terms
+
+    @staticmethod
+    def build(value):
+        if isinstance(value, _Run):
+            return value.cls._from_terms(value.terms)
+        return value
+
+
 def parse(tokens, flush=False):
-    """Parses the tokens list into an expression tree,
-    assuming parentheses are always present."""
+    """Parses the tokens (any iterable, e.g. the tokenize generator)
+    into an expression tree, assuming parentheses are always present.
+    Uses an operand stack and an operator stack instead of recursion,
+    so deeply nested expressions do not hit the recursion limit."""
     operators = {"+": Add, "-": Sub, "*": Mul, "/": Div}
     start = "("
     end = ")"
+    ops = []  # open brackets and pending operators
+    vals = []  # parsed operands
+    expect_operand = True
+    negate = False
 
-    def recursive_parse(index):
-        """Recursively parses the tokens to build the expression."""
-        token = tokens[index]
+    for token in tokens:
         if token == start:
-            # Skip the start bracket
-            left_exp, index = recursive_parse(index + 1)
-
+            if not expect_operand:
+                raise ValueError(f"Expected an operator, got {token!r}")
+            if negate:
+                raise ValueError(f"Expected a number after '-', got {token!r}")
+            ops.append(start)
+
+        elif token == end:
+            if (
+                expect_operand
+                or len(ops) < 2
+                or ops[-1] not in operators
+                or ops[-2] != start
+            ):
+                raise ValueError("String Expression is not properly Bracketed")
+            Op = ops.pop()
+            ops.pop()  # the matching start bracket
+            right_exp = vals.pop()
+            left_exp = vals.pop()
             if flush:
-                print(f"left: {left_exp}")
-
-            Op = tokens[index]
-            right_exp, index = recursive_parse(index + 1)
+                print(f"left: {_Run.build(left_exp)}")
+                print(f"right:{_Run.build(right_exp)}")
+
+            cls = operators[Op]
+            if issubclass(cls, AssocOp):
+                # extend a run of the same operator in place
+                runs = [v for v in (left_exp, right_exp) if type(v) is _Run]
+                runs = [run for run in runs if run.cls is cls]
+                out = max(runs, key=lambda run: len(run.terms), default=None)
+                if out is None:
+                    out = _Run(cls, [])
+                for operand in (left_exp, right_exp):
+                    if operand is out:
+                        continue
+                    if operand in runs:
+                        out.terms.extend(operand.terms)
+                    else:
+                        out.terms.append(_Run.build(operand))
+            else:
+                out = cls._raw(_Run.build(left_exp), _Run.build(right_exp))
             if flush:
-                print(f"right:{right_exp}")
-
-            if tokens[index] is not end:
-                raise ValueError("String Expression is not properly Bracketed")
+                print(f"out: {_Run.build(out)}")
+            vals.append(out)
 
-            index += 1  # skip the end bracket
+        elif not expect_operand:
+            if token not in operators:
+                raise ValueError(f"Expected an operator, got {token!r}")
+            ops.append(token)
+            expect_operand = True
 
-            out = operators[Op](left_exp, right_exp)
-            if flush:
-                print(f"out: {out}")
-            return out, index
+        # negative numbers, the previous token was "(" or an operator
+        elif token == "-" and not negate:
+            negate = True
 
         # variables
-        elif token.isalpha():
-            return Var(token), index + 1
+        elif token.isidentifier() and not negate:
+            vals.append(Var(token))
+            expect_operand = False
 
         # numbers
         else:
-            return Num(float(token)), index + 1
-
-    parsed_expression, _ = recursive_parse(0)
-    return parsed_expression
-
-
-def tokenize(expression):
-    """Helper function that takes in a string of expression
-    and tokenises accordingly, to be fed into the parse function"""
-    special_ops = {"+", "-", "*", "/", "(", ")"}
-    num_chars = set("0123456789.")
-    out_tokens = []
-    curr_char = ""
-    prev_token = None
+            n = float(token)
+            vals.append(Num(-n if negate else n))
+            expect_operand = False
+            negate = False
 
-    for char in expression:
+        # a complete expression, anything after it is ignored
+        if not ops and not expect_operand:
+            break
 
-        if char == " ":
-            continue
+    if ops or len(vals) != 1:
+        raise ValueError("String Expression is not properly Bracketed")
+    return _Run.build(vals[0])
 
-        if char in num_chars:
-            curr_char += char
 
-        elif char in special_ops:
-            if char == "-" and prev_token in {None, "(", "+", "-", "*", "/"}:
-                curr_char += char  # start of negative number
-            else:
-                if curr_char:
-                    out_tokens.append(curr_char)
-                    prev_token = curr_char
-                    curr_char = ""
-                out_tokens.append(char)
-                prev_token = char
-
-        else:
-            # variable/letter
-            if curr_char:
-                out_tokens.append(curr_char)
-                prev_token = curr_char
-                curr_char = ""
-            out_tokens.append(char)
-            prev_token = char
+# leading whitespace is part of each match, so scanning allocates one
+# match and one token string per token and nothing per skipped space
+_TOKEN_RE = re.compile(
+    r"\s*(?:(?P<num>\d+\.?\d*|\.\d+)|(?P<id>[^\W\d]\w*)|(?P<op>[-+*/()])|(?P<bad>\S))"
+)
 
-        prev_token = char
 
-    if curr_char:
-        out_tokens.append(curr_char)
-
-    return out_tokens
+def tokenize(expression):
+    """Helper function that takes in a string of expression
+    and yields its tokens, to be fed into the parse function"""
+    for match in _TOKEN_RE.finditer(expression):
+        kind = match.lastgroup
+        if kind == "bad":
+            char = match.group(kind)
+            raise ValueError(f"Unexpected character {char!r} in expression")
+        yield match.group(kind)
 
 
 def test_make_expression():
@@ -432,9 +1006,178 @@ def test_make_expression():
         ), f"Resultant expression: {str(result)}, \
                                         Expected expression: {str(exp_exp)}"
 
+    malformed_expressions = ["((x) + y)", "(x (y + z))", "(x + y", "(x + )", "(-(x + y))"]
+    for str_exp in malformed_expressions:
+        try:
+            result = make_expression(str_exp)
+        except ValueError:
+            continue
+        raise AssertionError(f"Malformed expression {str_exp} gave {result}")
+
+    # nested far deeper than the recursion limit
+    depth = 5000
+    str_exp = "(" * depth + "x" + " + 1)" * depth
+    result = make_expression(str_exp)
+    assert result is Var("x") + float(depth), f"Resultant expression: {str(result)}"
+
     print("All Test Passed")
 
 
+def test_evaluate_arrays():
+    """Custom test function for evaluate with NumPy
+    arrays in the mapping"""
+    try:
+        import numpy as np
+    except ImportError:
+        return
+
+    x = Var("x")
+    xs = np.linspace(0, 1, 5)
+
+    result = (x * x + 1).evaluate({"x": xs})
+    assert result.shape == xs.shape, f"Resultant shape: {result.shape}"
+
+    # expressions folded to a constant evaluate to a number, not an array
+    for expression in (x * 0, (x * x).deriv("y")):
+        assert expression.evaluate({"x": xs}) == 0
+        assert expression.compile().evaluate({"x": xs}) == 0
+        assert expression.lower()() == 0
+
+
+def _shared_expression():
+    """Expression in which x * y + 1 appears three times, with
+    a mapping to evaluate it, for the tests of cse and compile"""
+    x, y = Var("x"), Var("y")
+    shared = x * y + 1
+    return (shared * shared) / (shared - x), {"x": 2.0, "y": 3.0}
+
+
+def _assert_agrees(expression, mapping, result):
+    """Checks result against expression.evaluate(mapping)"""
+    expected = expression.evaluate(mapping)
+    assert result == expected, f"Resultant value: {result}, \
+                                        Expected value: {expected}"
+
+
+def test_cse():
+    """Custom test function for cse"""
+    expression, mapping = _shared_expression()
+    result = cse(expression)
+    square, difference = result.left, result.right
+    assert square.left is square.right is difference.left
+
+    # one value per distinct operation: x * y, x * y + 1, its square,
+    # the difference and the quotient
+    memo = {}
+    _assert_agrees(expression, mapping, result.evaluate(mapping, memo))
+    assert len(memo) == 5, f"Evaluated {len(memo)} operations"
+
+    # Num(2) and Num(2.0) print and evaluate differently, so both stay
+    x = Var("x")
+    expression = x * 2 + x * 2.0
+    result = cse(expression)
+    assert result is expression and len(result.terms) == 2
+
+
+def test_compile():
+    """Custom test function for compile and Program"""
+    expression, mapping = _shared_expression()
+    _assert_agrees(expression, mapping, expression.compile().evaluate(mapping))
+
+    # a lone number or variable takes one slot and no instructions
+    for expression in (Num(4), Var("x")):
+        program = expression.compile()
+        assert program.size == 1 and not program.instructions
+        _assert_agrees(expression, mapping, program.evaluate(mapping))
+
+    try:
+        (Var("x") * Var("y")).compile().evaluate({"x": 2.0})
+    except SymbolicEvaluationError:
+        pass
+    else:
+        raise AssertionError("Missing variable was not reported")
+
+
+def test_lower():
+    """Custom test function for lower"""
+    expression, mapping = _shared_expression()
+
+    for expression in (expression, Num(4), Var("x")):
+        names = sorted(expression.free_vars())
+        result = expression.lower()(*[mapping[name] for name in names])
+        _assert_agrees(expression, mapping, result)
+    # lowered once, then kept on the node
+    assert expression.lower() is expression.lower()
+
+
+def test_interning():
+    """Custom test function for the interning of nodes"""
+    import copy
+    import gc
+    import pickle
+
+    x = Var("x")
+    assert x is Var("x") and Num(2) is Num(2)
+    assert Num(2) is not Num(2.0) and Num(0.0) is not Num(-0.0)
+    assert x - 2 is Var("x") - Num(2)
+
+    expression = (x - 2) / (x * 3)
+    for clone in (copy.copy, copy.deepcopy, lambda e: pickle.loads(pickle.dumps(e))):
+        assert clone(expression) is expression
+
+    # the cache does not keep nodes alive
+    node = weakref.ref(Var("unused") - 1)
+    gc.collect()
+    assert node() is None
+
+
+def test_flattening():
+    """Custom test function for the flat terms of Add and Mul"""
+    x, y, z = Var("x"), Var("y"), Var("z")
+    expression = (x + y) + z
+    assert type(expression) is Add and len(expression.terms) == 3
+    assert x + (y + z) is expression
+    assert make_expression("((x + y) + z)") is expression
+
+    # left and right give the pairwise view of the terms
+    first, *rest = expression.terms
+    assert expression.left is first
+    assert expression.right is Add._from_terms(rest)
+    assert eval(repr(expression)) is expression
+
+    # numbers are folded into one term
+    assert (x * 2) * (y * 3) is Mul._from_terms((Num(6), x, y))
+
+
+def test_deriv():
+    """Custom test function for deriv and its cache"""
+    x, y = Var("x"), Var("y")
+    shared = x - y
+    expression = (x * x * y) / shared + shared
+
+    result = expression.deriv("x")
+    value = result.evaluate({"x": 3, "y": 2})
+    assert value == -5, f"Resultant value: {value}, Expected value: -5"
+
+    # kept per node and variable, shared nodes included
+    assert expression.deriv("x") is result
+    assert "x" in shared._deriv_cache and "y" not in shared._deriv_cache
+    assert (x * x * y).deriv("y") is x * x
+
+
+def test_canonical_order():
+    """Custom test function for the order of the
+    operands of Add and Mul"""
+    # the crc32 of these names is the same, so only the tie-break
+    # keeps them in one order
+    a, b, c = Var("plumless"), Var("buckeroo"), Var("c")
+    assert a._hash == b._hash
+
+    pairs = [(a + b, b + a), (a * b * c, c * b * a), ((a + c) + b, (b + c) + a)]
+    for left, right in pairs:
+        assert left is right, f"{left} and {right} are different nodes"
+
+
 if __name__ == "__main__":
     pass
     # Testing the function
@@ -457,4 +1200,12 @@ if __name__ == "__main__":
     # result1 = make_expression(string_expression[2])
     # print(result1)
     # print(expected_expression[2])
+    test_interning()
+    test_flattening()
+    test_deriv()
+    test_canonical_order()
+    test_evaluate_arrays()
+    test_cse()
+    test_compile()
+    test_lower()
     test_make_expression()